@@ -1,6 +1,6 @@
 #!/usr/bin/env -S python3 -u
 
-import os
+import shutil
 import subprocess
 from datetime import datetime
 import signal
@@ -10,45 +10,118 @@ import argparse
 
 from config import get_config, BackupConfig, TIMESTAMP_FORMAT
 from compression import get_compressor_by_name
+from pipeline import Pipeline, StreamStage, mbuffer_stage
+from s3 import UploadStream, aioboto_available, part_size_for
+
+
+# Snapshot lists keyed by (dataset, prefix), kept in sync by create/destroy_snapshot.
+_snapshot_cache: dict[tuple[str, str], list[str]] = {}
+
+
+def invalidate_snapshot_cache():
+    """Forget cached snapshot lists so the next get_snapshots() call queries zfs."""
+    _snapshot_cache.clear()
 
 
 def get_snapshots(config: BackupConfig):
-    """Get a list of ZFS snapshots for the dataset."""
-    cmd = f"zfs list -t snapshot -o name -s creation -r {config.zfs_dataset}"
-    result = subprocess.run(cmd, shell=True, check=True, stdout=subprocess.PIPE, text=True)
+    """Get a list of ZFS snapshots for the dataset, oldest first."""
+    key = (config.zfs_dataset, config.snapshot_prefix)
+    if key in _snapshot_cache:
+        return list(_snapshot_cache[key])
+
+    # Sorting by name avoids loading the creation property of every snapshot, and
+    # gives the same order for our snapshots since TIMESTAMP_FORMAT sorts lexicographically.
+    # -d 1 keeps zfs from walking the snapshots of child datasets.
+    cmd = ['zfs', 'list', '-H', '-t', 'snapshot', '-o', 'name', '-s', 'name', '-d', '1', config.zfs_dataset]
+    result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, text=True)
     snapshots = result.stdout.strip().split('\n')
-    return [s for s in snapshots if f'{config.zfs_dataset}@{config.snapshot_prefix}' in s]
+    prefix = f'{config.zfs_dataset}@{config.snapshot_prefix}'
+    _snapshot_cache[key] = [s for s in snapshots if s.startswith(prefix)]
+    return list(_snapshot_cache[key])
 
 
 def create_snapshot(snapshot_name):
     """Create a new ZFS snapshot."""
-    cmd = f'zfs snapshot {snapshot_name}'
-    subprocess.run(cmd, shell=True, check=True)
+    cmd = ['zfs', 'snapshot', snapshot_name]
+    subprocess.run(cmd, check=True)
 
+    # A new snapshot has the latest timestamp, so it goes at the end of any list it belongs to.
+    for (dataset, prefix), snapshots in _snapshot_cache.items():
+        if snapshot_name.startswith(f'{dataset}@{prefix}'):
+            snapshots.append(snapshot_name)
 
-def backup_snapshot(config: BackupConfig, snapshot_name, last_snapshot=None):
+
+def estimate_send_size(send_args):
+    """Return the stream size zfs send reports for a dry run, or None if unavailable."""
+    cmd = ['zfs', 'send', '-nP', *send_args]
+    try:
+        # Older zfs releases print the dry-run summary to stderr.
+        result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    except subprocess.CalledProcessError:
+        return None
+    for line in result.stdout.splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[0] == 'size':
+            return int(fields[1])
+    return None
+
+
+def upload_stage(config: BackupConfig, remote_name: str, upload_backend: str, estimated_size=None):
+    """Return the pipeline stage that uploads its input as remote_name in the bucket."""
+    if upload_backend == 'aioboto':
+        upload = UploadStream(
+            config.bucket_name, remote_name,
+            concurrency=config.s3_upload_concurrency,
+            storage_class=config.s3_storage_class,
+            part_size=part_size_for(estimated_size),
+        )
+        return StreamStage(
+            name=f's3 multipart upload {config.bucket_name}/{remote_name}',
+            func=lambda src, _: upload.run(src),
+            cancel=upload.cancel,
+        )
+
+    remote_path = f'{config.rclone_remote}:{config.bucket_name}/{remote_name}'
+    return ['rclone', '--config', config.rclone_config_path, 'rcat', remote_path, '--stats-one-line']
+
+
+def backup_snapshot(config: BackupConfig, snapshot_name, last_snapshot=None, upload_backend='rclone'):
     """Backup a ZFS snapshot to S3 Glacier."""
     compressor = get_compressor_by_name(config.compressor)
 
     if last_snapshot:
         # Incremental backup
         print(f'Creating incremental backup from {last_snapshot} to {snapshot_name}')
-        zfs_cmd = f'zfs send -v -c -i {last_snapshot} {snapshot_name}'
-        remote_path = f'{config.rclone_remote}:{config.bucket_name}/{snapshot_name}-incremental.{compressor.extension}'
+        send_args = ['-c', '-i', last_snapshot, snapshot_name]
+        remote_name = f'{snapshot_name}-incremental.{compressor.extension}'
     else:
         # Full backup
         print(f'Creating full backup of {snapshot_name}')
-        zfs_cmd = f'zfs send -v -c {snapshot_name}'
-        remote_path = f'{config.rclone_remote}:{config.bucket_name}/{snapshot_name}-full.{compressor.extension}'
-
-    rclone_cmd = f'rclone --config {config.rclone_config_path} rcat {remote_path} --stats-one-line'
+        send_args = ['-c', snapshot_name]
+        remote_name = f'{snapshot_name}-full.{compressor.extension}'
+
+    use_pv = shutil.which('pv') is not None
+    size = estimate_send_size(send_args) if use_pv or upload_backend == 'aioboto' else None
+
+    if use_pv:
+        # pv reports byte-level progress and ETA, so zfs send can skip its verbose output.
+        zfs_cmd = ['zfs', 'send', *send_args]
+        progress_cmd = ['pv', '-f', '-i', '5']
+        if size is not None:
+            progress_cmd += ['-s', str(size)]
+    else:
+        zfs_cmd = ['zfs', 'send', '-v', *send_args]
+        progress_cmd = None
 
-    full_cmd = f'set -o pipefail; {zfs_cmd} | {compressor.compress_cmd} | {rclone_cmd}'
+    stages = [zfs_cmd, progress_cmd, mbuffer_stage(config.send_buffer)]
+    if compress_stage := compressor.compress_stage():
+        stages += [compress_stage, mbuffer_stage(config.upload_buffer)]
+    stages.append(upload_stage(config, remote_name, upload_backend, size))
 
-    print(f'Running backup: {full_cmd}')
+    pipeline = Pipeline(stages)
 
-    process = subprocess.Popen(full_cmd, shell=True, executable='/bin/bash', preexec_fn=os.setsid)
-    return process
+    print(f'Running backup: {pipeline}')
+    return pipeline
 
 
 def prune_snapshots(config: BackupConfig):
@@ -63,28 +136,74 @@ def prune_snapshots(config: BackupConfig):
     if len(snapshots) > config.snapshot_retention:
         snapshots_to_prune = snapshots[:len(snapshots) - config.snapshot_retention]
         print(f"Pruning {len(snapshots_to_prune)} old snapshots...")
-        for snapshot in snapshots_to_prune:
-            destroy_snapshot(snapshot, silent=True)
-
 
-def destroy_snapshot(snapshot_name, silent=False):
-    """Destroy a ZFS snapshot, with retries on busy error."""
+        for batch in _destroy_batches(config.zfs_dataset, snapshots_to_prune):
+            destroyed, error = _destroy(batch, silent=True)
+            if not destroyed:
+                # The batch is atomic, so one busy or cloned snapshot blocks the rest;
+                # destroy the others individually.
+                print(f"Batch destroy failed, pruning snapshots one by one: {error}")
+                for snapshot in _batch_snapshots(batch):
+                    _destroy(snapshot, silent=True, retries=1)
+
+
+# Linux limit on the length of a single argument (MAX_ARG_STRLEN), including the NUL.
+_MAX_ARG_LEN = 128 * 1024
+
+
+def _destroy_batches(dataset, snapshots):
+    """Group snapshots into dataset@snap1,snap2,... arguments that fit in one argv element.
+
+    zfs destroy removes each such list in one transaction.
+    """
+    batches = []
+    names = []
+    length = len(dataset) + 1
+    for snapshot in snapshots:
+        name = snapshot.split('@', 1)[1]
+        if names and length + 1 + len(name) >= _MAX_ARG_LEN:
+            batches.append(f"{dataset}@{','.join(names)}")
+            names = []
+            length = len(dataset) + 1
+        length += len(name) + (1 if names else 0)
+        names.append(name)
+    if names:
+        batches.append(f"{dataset}@{','.join(names)}")
+    return batches
+
+
+def _batch_snapshots(batch):
+    """Split a dataset@snap1,snap2,... argument back into full snapshot names."""
+    dataset, names = batch.split('@', 1)
+    return [f'{dataset}@{name}' for name in names.split(',')]
+
+
+def destroy_snapshot(snapshot_name, silent=False, retries=5):
+    """Destroy a ZFS snapshot, with retries on busy error. Returns True on success."""
     if not snapshot_name:
-        return
+        return False
+    destroyed, _ = _destroy(snapshot_name, silent, retries)
+    return destroyed
+
 
+def _destroy(snapshot_name, silent=False, retries=5):
+    """Run zfs destroy with retries on busy error.
+
+    Returns (True, '') on success, or (False, error) with the zfs error output.
+    """
     if not silent:
         print(f"Destroying snapshot: {snapshot_name}")
 
-    retries = 5
     delay = 2  # seconds
 
     for attempt in range(retries):
         try:
-            cmd = f'zfs destroy {snapshot_name}'
-            subprocess.run(cmd, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            cmd = ['zfs', 'destroy', snapshot_name]
+            subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            invalidate_snapshot_cache()
             if not silent:
                 print(f"Successfully destroyed snapshot {snapshot_name}")
-            return  # Success
+            return True, ''
         except subprocess.CalledProcessError as e:
             stderr_output = e.stderr.decode().strip()
             if 'dataset is busy' in stderr_output and attempt < retries - 1:
@@ -94,7 +213,7 @@ def destroy_snapshot(snapshot_name, silent=False):
             else:
                 if not silent:
                     print(f"Failed to destroy snapshot {snapshot_name}: {stderr_output}")
-                break  # Failed for good
+                return False, stderr_output  # Failed for good
 
 
 def main():
@@ -103,8 +222,14 @@ def main():
     parser = argparse.ArgumentParser(description="ZFS backup script with rclone.")
     parser.add_argument("--full", action="store_true", help="Force a full backup, even if previous snapshots exist.")
     parser.add_argument("--config", default="config.ini", help="Path to the configuration file.")
+    parser.add_argument("--upload-backend", choices=["rclone", "aioboto"], default="rclone",
+                        help="Upload with 'rclone rcat' or directly to S3 with concurrent multipart uploads via aiobotocore.")
     args = parser.parse_args()
 
+    if args.upload_backend == "aioboto" and not aioboto_available():
+        print("Error: The aioboto upload backend requires the 'aiobotocore' package.")
+        sys.exit(1)
+
     def signal_handler(signum, frame):
         """Handle signals by raising KeyboardInterrupt."""
         print(f"\nReceived signal {signum}, shutting down gracefully...")
@@ -128,7 +253,7 @@ def main():
 
         create_snapshot(new_snapshot)
 
-        backup_process = backup_snapshot(config, new_snapshot, latest_snapshot)
+        backup_process = backup_snapshot(config, new_snapshot, latest_snapshot, args.upload_backend)
         backup_process.wait()
 
         if backup_process.returncode == 0:
@@ -142,11 +267,7 @@ def main():
         print("\nBackup interrupted by user or system.")
         if backup_process and backup_process.poll() is None:
             print("Terminating backup process group...")
-            try:
-                os.killpg(os.getpgid(backup_process.pid), signal.SIGTERM)
-                backup_process.wait()
-            except ProcessLookupError:
-                print("Backup process already finished.")
+            backup_process.terminate()
         destroy_snapshot(new_snapshot)
         sys.exit(1)
 
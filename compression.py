@@ -1,5 +1,15 @@
+import os
+import shutil
 from dataclasses import dataclass
-from typing import Optional
+from types import MappingProxyType
+from typing import BinaryIO, Optional
+
+from pipeline import IO_CHUNK_SIZE, Stage, StreamStage, split_cmd
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 @dataclass
 class Compressor:
@@ -9,24 +19,100 @@ class Compressor:
     decompress_cmd: str
     extension: str
 
+    def compress_stage(self) -> Optional[Stage]:
+        """Return the pipeline stage that compresses its input, or None if none is needed."""
+        return split_cmd(self.compress_cmd)
+
+    def decompress_stage(self) -> Optional[Stage]:
+        """Return the pipeline stage that decompresses its input, or None if none is needed."""
+        return split_cmd(self.decompress_cmd)
+
+    def can_decompress(self) -> bool:
+        """Return True if the decompressor is installed on this host."""
+        return shutil.which(split_cmd(self.decompress_cmd)[0]) is not None
+
+@dataclass
+class InProcCompressor(Compressor):
+    """A Zstandard compressor that runs inside this process via python-zstandard.
+
+    Saves the fork/exec of an external tool and one copy through its stdin
+    pipe. Falls back to the external commands if `zstandard` is not installed.
+    """
+    level: int = 3
+
+    def compress_stream(self, src: BinaryIO, dst: BinaryIO):
+        """Compress `src` into `dst` using all available cores."""
+        cctx = zstandard.ZstdCompressor(level=self.level, threads=-1)
+        cctx.copy_stream(src, dst, read_size=IO_CHUNK_SIZE, write_size=IO_CHUNK_SIZE)
+
+    def decompress_stream(self, src: BinaryIO, dst: BinaryIO):
+        """Decompress `src` into `dst`, including multi-frame input."""
+        dctx = zstandard.ZstdDecompressor()
+        with dctx.stream_reader(src, read_size=IO_CHUNK_SIZE, read_across_frames=True) as reader:
+            while chunk := reader.read(IO_CHUNK_SIZE):
+                dst.write(chunk)
+
+    def compress_stage(self) -> Stage:
+        if zstandard is None:
+            return super().compress_stage()
+        return StreamStage(name=f'{self.name} (in-process)', func=self.compress_stream)
+
+    def decompress_stage(self) -> Stage:
+        if zstandard is None:
+            return super().decompress_stage()
+        return StreamStage(name=f'{self.name} -d (in-process)', func=self.decompress_stream)
+
+    def can_decompress(self) -> bool:
+        return zstandard is not None or super().can_decompress()
+
+@dataclass
+class PassthroughCompressor(Compressor):
+    """Stores the zfs send stream as-is.
+
+    `zfs send -c` already emits the on-disk compressed blocks, so a second
+    compressor often costs a core for little gain. No pipeline stage is added.
+    """
+
+    def compress_stage(self) -> Optional[Stage]:
+        return None
+
+    def decompress_stage(self) -> Optional[Stage]:
+        return None
+
+    def can_decompress(self) -> bool:
+        return True
+
+# CPUs this process may run on, like nproc; cpu_count() ignores affinity masks and cgroup cpusets.
+_nproc = len(os.sched_getaffinity(0))
+
+# When several compressors share an extension, the last one listed that is installed is used
+# for decompression, so .zst falls back from pzstd to in-process zstd.
 COMPRESSORS = [
     Compressor(name='gzip', compress_cmd='gzip -c', decompress_cmd='gzip -d', extension='gz'),
+    Compressor(name='igzip', compress_cmd='igzip -c', decompress_cmd='igzip -d', extension='gz'),
     Compressor(name='pigz', compress_cmd='pigz -c', decompress_cmd='pigz -d', extension='gz'),
-    Compressor(name='zstd', compress_cmd='zstd -T0', decompress_cmd='zstd -d', extension='zst'),
+    InProcCompressor(name='zstd', compress_cmd='zstd -T0', decompress_cmd='zstd -d', extension='zst'),
+    # pzstd writes independent frames, so the stream can also be decompressed in parallel.
+    Compressor(name='pzstd', compress_cmd=f'pzstd -p {_nproc} -q', decompress_cmd=f'pzstd -d -p {_nproc} -q', extension='zst'),
+    PassthroughCompressor(name='none', compress_cmd='cat', decompress_cmd='cat', extension='zfs'),
 ]
 
-DEFAULT_COMPRESSOR = 'pigz'
+DEFAULT_COMPRESSOR = 'pzstd'
 
-_by_name = {c.name: c for c in COMPRESSORS}
-_by_extension = {c.extension: c for c in COMPRESSORS}
+_by_name = MappingProxyType({c.name: c for c in COMPRESSORS})
+# Filename suffixes paired with their decompressors in order of preference, built once for
+# get_compressor_by_filename.
+_suffixes = tuple((f'.{c.extension}', c) for c in reversed(COMPRESSORS))
 
 def get_compressor_by_name(name: str) -> Compressor:
     """Get a compressor by its name, falling back to the default."""
     return _by_name.get(name, _by_name[DEFAULT_COMPRESSOR])
 
 def get_compressor_by_filename(filename: str) -> Optional[Compressor]:
-    """Get a compressor by the file extension in a filename."""
-    for ext, compressor in _by_extension.items():
-        if filename.endswith(f'.{ext}'):
-            return compressor
-    return None
+    """Get a compressor by the file extension in a filename.
+
+    Prefers one that is installed; otherwise returns the preferred one, whose
+    stage will then report the missing command.
+    """
+    matches = [c for suffix, c in _suffixes if filename.endswith(suffix)]
+    return next((c for c in matches if c.can_decompress()), matches[0] if matches else None)
@@ -2,6 +2,8 @@ import configparser
 import sys
 from dataclasses import dataclass
 
+from compression import DEFAULT_COMPRESSOR
+
 TIMESTAMP_FORMAT = '%Y-%m-%d_%H-%M-%S'
 
 
@@ -21,6 +23,14 @@ class BackupConfig:
     # [compression]
     compressor: str
 
+    # [buffer]
+    send_buffer: str
+    upload_buffer: str
+
+    # [s3]
+    s3_storage_class: str
+    s3_upload_concurrency: int
+
 
 def get_config(config_path: str) -> BackupConfig:
     """Read configuration from the specified path and return a typed dataclass."""
@@ -42,8 +52,18 @@ def get_config(config_path: str) -> BackupConfig:
             rclone_config_path=parser.get('rclone', 'config_path'),
 
             # [compression]
-            compressor=parser.get('compression', 'compressor', fallback='pigz')
+            compressor=parser.get('compression', 'compressor', fallback=DEFAULT_COMPRESSOR),
+
+            # [buffer]
+            send_buffer=parser.get('buffer', 'send_buffer', fallback='1G'),
+            upload_buffer=parser.get('buffer', 'upload_buffer', fallback='512M'),
+
+            # [s3]
+            s3_storage_class=parser.get('s3', 'storage_class', fallback='STANDARD'),
+            s3_upload_concurrency=parser.getint('s3', 'upload_concurrency', fallback=8),
         )
+        if config.s3_upload_concurrency < 1:
+            raise ValueError(f"upload_concurrency must be at least 1, got {config.s3_upload_concurrency}")
         return config
     except (configparser.NoSectionError, configparser.NoOptionError) as e:
         print(f"Error: Missing configuration option in '{config_path}': {e}")
@@ -0,0 +1,229 @@
+import fcntl
+import os
+import shlex
+import shutil
+import signal
+import subprocess
+import threading
+from dataclasses import dataclass
+from typing import BinaryIO, Callable, Optional, Union
+
+# Linux-specific fcntl command, not exposed by the fcntl module on older Pythons.
+F_SETPIPE_SZ = 1031
+
+# Desired capacity for the pipes between stages. The default 64 KiB pipe makes
+# zfs send stall whenever the uploader pauses to flush.
+PIPE_CAPACITY = 32 * 1024 * 1024
+
+# Buffer and read size for stream data handled in this process: the pipe ends of
+# in-process stages, compression and S3 downloads. Well above the 128 KiB ZFS
+# record size and the 8 KiB io.DEFAULT_BUFFER_SIZE.
+IO_CHUNK_SIZE = 1 << 20
+
+
+def _read_pipe_max_size() -> int:
+    """Read the system-wide limit for F_SETPIPE_SZ."""
+    try:
+        with open('/proc/sys/fs/pipe-max-size') as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return PIPE_CAPACITY
+
+
+_pipe_size = min(PIPE_CAPACITY, _read_pipe_max_size())
+
+
+def make_pipe() -> tuple[int, int]:
+    """Create a pipe and grow its capacity as far as the kernel allows."""
+    read_fd, write_fd = os.pipe()
+    try:
+        fcntl.fcntl(write_fd, F_SETPIPE_SZ, _pipe_size)
+    except OSError:
+        # The per-user pipe buffer quota may be exhausted; the default size still works.
+        pass
+    return read_fd, write_fd
+
+
+def mbuffer_stage(size: str) -> Optional[list[str]]:
+    """Return an mbuffer stage of the given size, or None if mbuffer is not installed."""
+    if shutil.which('mbuffer') is None:
+        return None
+    return ['mbuffer', '-q', '-s', '128k', '-m', size]
+
+
+def split_cmd(cmd: str) -> list[str]:
+    """Split a configured command string into an argument vector."""
+    return shlex.split(cmd)
+
+
+@dataclass
+class StreamStage:
+    """A pipeline stage that runs `func(src, dst)` in a thread of this process.
+
+    `src` and `dst` are binary file objects wrapping the neighbouring pipes,
+    or None for the first or last stage. They are closed after `func` returns.
+    `cancel`, if given, is called when the pipeline is terminated, so a stage
+    can tell an aborted run apart from a clean end of input.
+    """
+    name: str
+    func: Callable[[Optional[BinaryIO], Optional[BinaryIO]], None]
+    cancel: Optional[Callable[[], None]] = None
+
+
+Stage = Union[list[str], StreamStage]
+
+
+class _StreamThread(threading.Thread):
+    """Runs a StreamStage and exposes a Popen-like poll/wait interface."""
+
+    def __init__(self, stage: StreamStage, src_fd: Optional[int], dst_fd: Optional[int]):
+        super().__init__(name=stage.name, daemon=True)
+        self.stage = stage
+        self.src = open(src_fd, 'rb', buffering=IO_CHUNK_SIZE) if src_fd is not None else None
+        self.dst = open(dst_fd, 'wb', buffering=IO_CHUNK_SIZE) if dst_fd is not None else None
+        self.returncode: Optional[int] = None
+
+    def run(self):
+        try:
+            self.stage.func(self.src, self.dst)
+            if self.dst:
+                self.dst.flush()
+            self.returncode = 0
+        except Exception as e:
+            print(f"Stage '{self.stage.name}' failed: {e}")
+            self.returncode = 1
+        finally:
+            for f in (self.src, self.dst):
+                if f:
+                    try:
+                        f.close()
+                    except OSError:
+                        # Unflushed output to a stage that already exited.
+                        pass
+
+    def poll(self) -> Optional[int]:
+        return self.returncode
+
+    def wait(self) -> int:
+        self.join()
+        return self.returncode
+
+
+class _FailedStage:
+    """Stands in for a stage whose command could not be started."""
+    returncode = 127
+
+    def poll(self) -> int:
+        return self.returncode
+
+    def wait(self) -> int:
+        return self.returncode
+
+
+class Pipeline:
+    """A chain of stages connected by enlarged pipes, equivalent to `a | b | c` with pipefail.
+
+    External stages run in a single new process group so the whole chain can
+    be signalled at once, and terminal signals aimed at the script do not
+    reach it directly. Stages given as None are skipped.
+
+    Adjacent external stages are handed the two ends of the same pipe, so the
+    data between them stays in the kernel and never passes through this
+    process. Only StreamStages read or write it here.
+    """
+
+    def __init__(self, stages: list[Optional[Stage]], stdin: Optional[int] = None, stdout: Optional[int] = None):
+        """Start all stages. `stdin` and `stdout`, if given, are file descriptors
+        for the ends of the chain; the pipeline takes ownership of them."""
+        self.stages = [s for s in stages if s]
+        self.processes: list[Union[subprocess.Popen, _StreamThread, _FailedStage]] = []
+        self.returncode: Optional[int] = None
+        self.pgid: Optional[int] = None
+
+        try:
+            for i, stage in enumerate(self.stages):
+                is_last = i == len(self.stages) - 1
+                if is_last:
+                    read_fd, write_fd = None, stdout
+                    stdout = None
+                else:
+                    read_fd, write_fd = make_pipe()
+
+                if isinstance(stage, StreamStage):
+                    # The thread takes ownership of both ends it is handed.
+                    process = _StreamThread(stage, stdin, write_fd)
+                    process.start()
+                    self.processes.append(process)
+                    stdin = read_fd
+                    continue
+
+                # The first stage leads a new process group; the rest join it. process_group
+                # is applied by the C fork code, unlike preexec_fn, so it is safe while
+                # in-process stages are running in other threads.
+                try:
+                    process = subprocess.Popen(stage, stdin=stdin, stdout=write_fd, process_group=self.pgid or 0)
+                except OSError as e:
+                    # Like a shell: report the stage as failed and let its neighbours see EOF/EPIPE.
+                    print(f"{stage[0]}: {e.strerror}")
+                    process = _FailedStage()
+                except BaseException:
+                    if read_fd is not None:
+                        os.close(read_fd)
+                    raise
+                finally:
+                    # The child holds its own copies; keeping ours open would hide EOF.
+                    if stdin is not None:
+                        os.close(stdin)
+                        stdin = None
+                    if write_fd is not None:
+                        os.close(write_fd)
+
+                self.processes.append(process)
+                if self.pgid is None and isinstance(process, subprocess.Popen):
+                    self.pgid = process.pid
+                stdin = read_fd
+        except BaseException:
+            for fd in (stdin, stdout):
+                if fd is not None:
+                    os.close(fd)
+            self.terminate()
+            raise
+
+    def __str__(self) -> str:
+        return ' | '.join(
+            f'<{stage.name}>' if isinstance(stage, StreamStage) else shlex.join(stage)
+            for stage in self.stages
+        )
+
+    def _collect(self, codes: list[Optional[int]]) -> Optional[int]:
+        """Combine per-stage exit codes the way bash's pipefail does."""
+        if any(code is None for code in codes):
+            return None
+        failed = [code for code in codes if code != 0]
+        self.returncode = failed[-1] if failed else 0
+        return self.returncode
+
+    def poll(self) -> Optional[int]:
+        """Return the pipeline exit code, or None if any stage is still running."""
+        return self._collect([p.poll() for p in self.processes])
+
+    def wait(self) -> int:
+        """Wait for every stage to finish and return the pipeline exit code."""
+        return self._collect([p.wait() for p in self.processes])
+
+    def terminate(self):
+        """Send SIGTERM to every external stage and wait for all stages to exit.
+
+        In-process stages are cancelled first, then stop on their own once
+        their neighbouring processes are gone.
+        """
+        for stage in self.stages:
+            if isinstance(stage, StreamStage) and stage.cancel:
+                stage.cancel()
+        if self.pgid is not None:
+            try:
+                os.killpg(self.pgid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for p in self.processes:
+            p.wait()
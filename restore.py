@@ -1,15 +1,30 @@
 #!/usr/bin/env -S python3 -u
 
 import argparse
+import os
+import re
 import subprocess
 import sys
 from datetime import datetime
 import json
 
-from dataclasses import dataclass, fields
+from dataclasses import dataclass
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 from enum import Enum
-from config import get_config, BackupConfig, TIMESTAMP_FORMAT
+from config import get_config, BackupConfig
 from compression import get_compressor_by_filename
+from pipeline import IO_CHUNK_SIZE, Pipeline, StreamStage, make_pipe, mbuffer_stage
+from s3 import DownloadStream, boto3_available, create_client
 
 
 class BackupType(Enum):
@@ -17,18 +32,15 @@ class BackupType(Enum):
     INCREMENTAL = 'incremental'
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class RcloneFile:
     """Represents a file listed by 'rclone lsjson'."""
     Path: str
     Name: str
     Size: int
-    MimeType: str
-    ModTime: str
-    IsDir: bool
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class BackupInfo:
     """Represents a parsed backup file with its metadata."""
     path: str
@@ -37,126 +49,198 @@ class BackupInfo:
     type: BackupType
     size: int
 
-def human_readable_size(size, decimal_places=2):
-    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
-        if size < 1024.0:
-            return f"{size:.{decimal_places}f}{unit}"
-        size /= 1024.0
+_SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB')
+
+
+def human_readable_size(size: int, decimal_places=2):
+    if size <= 0:
+        return f"{0:.{decimal_places}f}B"
+    # Each unit is 2**10 times the previous one, so the bit length picks it directly.
+    i = min((size.bit_length() - 1) // 10, len(_SIZE_UNITS) - 1)
+    return f"{size / (1 << (10 * i)):.{decimal_places}f}{_SIZE_UNITS[i]}"
+
+
+def _parse_lsjson(stream, prefix: str) -> list[RcloneFile]:
+    """Parse 'rclone lsjson' output, keeping only files whose path starts with prefix."""
+    if ijson is not None:
+        # Streams the array instead of materializing the whole listing at once.
+        items = ijson.items(stream, 'item')
+    else:
+        items = json_loads(stream.read())
+
+    files = []
+    for f_json in items:
+        path = f_json['Path']
+        if not path.startswith(prefix):
+            continue
+        files.append(RcloneFile(Path=path, Name=f_json['Name'], Size=f_json['Size']))
+    return files
+
+
+_JSON_ERRORS = (json.JSONDecodeError, ijson.JSONError) if ijson is not None else (json.JSONDecodeError,)
 
 
 def list_backups(config: BackupConfig) -> list[RcloneFile]:
-    """List all backup files in the rclone remote."""
+    """List all backup files of the dataset in the rclone remote."""
     remote_path = f'{config.rclone_remote}:{config.bucket_name}'
-    cmd = f'rclone --config {config.rclone_config_path} lsjson --recursive  --include "{config.zfs_dataset}*" --files-only {remote_path}'
-    
-    try:
-        result = subprocess.run(cmd, shell=True, check=True, stdout=subprocess.PIPE, text=True)
-        files_json = json.loads(result.stdout)
-        
-        rclone_file_fields = {f.name for f in fields(RcloneFile)}
-        
-        files = []
-        for f_json in files_json:
-            filtered_data = {k: v for k, v in f_json.items() if k in rclone_file_fields}
-            files.append(RcloneFile(**filtered_data))
-        return files
-    except subprocess.CalledProcessError as e:
-        print(f"Error listing backups: {e}")
+    cmd = [
+        'rclone', '--config', config.rclone_config_path, 'lsjson', '--recursive',
+        '--include', f'{config.zfs_dataset}*', '--files-only', remote_path,
+    ]
+    prefix = f'{config.zfs_dataset}@{config.snapshot_prefix}'
+
+    # Binary stdout with a large buffer; the JSON parsers decode it themselves.
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=IO_CHUNK_SIZE) as proc:
+        try:
+            files = _parse_lsjson(proc.stdout, prefix)
+            parse_error = None
+        except _JSON_ERRORS as e:
+            # A failed rclone leaves empty or truncated output; drain it and check the exit code first.
+            proc.communicate()
+            parse_error = e
+
+    if proc.returncode != 0:
+        print(f"Error listing backups: {subprocess.CalledProcessError(proc.returncode, cmd)}")
         sys.exit(1)
-    except json.JSONDecodeError as e:
-        print(f"Error parsing rclone output: {e}")
+    if parse_error:
+        print(f"Error parsing rclone output: {parse_error}")
         sys.exit(1)
+    return files
 
 
 def find_backup_chain(backups: list[RcloneFile], config: BackupConfig) -> tuple[BackupInfo | None, list[BackupInfo]]:
     """Find the latest full backup and subsequent incremental backups."""
-    dataset_backups: list[BackupInfo] = []
+    # Expected format: pool/dataset@prefix-YYYY-MM-DD_HH-MM-SS-full.ext
+    # or pool/dataset@prefix-YYYY-MM-DD_HH-MM-SS-incremental.ext
+    # The timestamp groups follow TIMESTAMP_FORMAT.
+    prefix = f'{config.zfs_dataset}@{config.snapshot_prefix}'
+    backup_re = re.compile(
+        rf'^{re.escape(prefix)}(\d{{4}})-(\d{{2}})-(\d{{2}})_(\d{{2}})-(\d{{2}})-(\d{{2}})-(full|incremental)\.[a-z]+$'
+    )
+
+    last_full_backup: BackupInfo | None = None
+    incremental_backups: list[BackupInfo] = []
     for b in backups:
-        # Expected format: pool/dataset@prefix-YYYY-MM-DD_HH-MM-SS-full.ext
-        # or pool/dataset@prefix-YYYY-MM-DD_HH-MM-SS-incremental.ext
         path: str = b.Path
-        if not path.startswith(f'{config.zfs_dataset}@{config.snapshot_prefix}'):
+        if not path.startswith(prefix):
             continue
 
-        parts = path.rsplit('-', 1)
-        if len(parts) != 2:
+        match = backup_re.match(path)
+        if not match:
+            print(f"Could not parse backup name: {path}")
             continue
-            
-        backup_type_str, _ = (parts[1].split('.', 1) + [''])[0:2]
 
         try:
-            backup_type = BackupType(backup_type_str)
+            timestamp = datetime(*map(int, match.groups()[:6]))
         except ValueError:
-            print(f"Could not parse backup type from: {path}")
-            continue
-            
-        # Extract timestamp from snapshot name
-        try:
-            snapshot_name = parts[0]
-            timestamp_str = snapshot_name.split(config.snapshot_prefix)[1]
-            timestamp = datetime.strptime(timestamp_str, TIMESTAMP_FORMAT)
-            dataset_backups.append(BackupInfo(
-                path=path,
-                snapshot_name=snapshot_name,
-                timestamp=timestamp,
-                type=backup_type,
-                size=b.Size
-            ))
-        except (ValueError, IndexError):
             print(f"Could not parse timestamp from: {path}")
             continue
 
-    if not dataset_backups:
-        return None, []
-
-    # Sort by timestamp
-    dataset_backups.sort(key=lambda x: x.timestamp)
-    
-    # Find the last full backup
-    last_full_backup = None
-    for backup in reversed(dataset_backups):
+        backup = BackupInfo(
+            path=path,
+            snapshot_name=path[:match.end(6)],
+            timestamp=timestamp,
+            type=BackupType(match.group(7)),
+            size=b.Size
+        )
         if backup.type == BackupType.FULL:
-            last_full_backup = backup
-            break
-            
+            if last_full_backup is None or backup.timestamp >= last_full_backup.timestamp:
+                last_full_backup = backup
+        else:
+            incremental_backups.append(backup)
+
     if not last_full_backup:
         return None, []
-        
-    # Find all incremental backups after the last full backup
-    incremental_backups = []
-    for backup in dataset_backups:
-        if backup.type == BackupType.INCREMENTAL and backup.timestamp > last_full_backup.timestamp:
-            incremental_backups.append(backup)
-            
+
+    # Only the incrementals after the last full backup need ordering for zfs receive.
+    incremental_backups = [b for b in incremental_backups if b.timestamp > last_full_backup.timestamp]
+    incremental_backups.sort(key=lambda x: x.timestamp)
     return last_full_backup, incremental_backups
 
 
-def restore_backup(config: BackupConfig, backup_path: str, target_dataset: str):
-    """Restore a single backup file to the target dataset."""
+def download_stage(config: BackupConfig, backup_path: str, s3_client=None):
+    """Return the pipeline stage that downloads a backup file.
+
+    Uses the shared boto3 client if one is given, otherwise 'rclone cat'.
+    """
+    if s3_client is not None:
+        download = DownloadStream(s3_client, config.bucket_name, backup_path)
+        return StreamStage(
+            name=f's3 get {config.bucket_name}/{backup_path}',
+            func=lambda _, dst: download.run(dst),
+            cancel=download.cancel,
+        )
+
     remote_path = f'{config.rclone_remote}:{config.bucket_name}/{backup_path}'
+    return ['rclone', '--config', config.rclone_config_path, 'cat', remote_path]
+
+
+def fetch_backup(config: BackupConfig, backup_path: str, s3_client=None) -> tuple[Pipeline, int]:
+    """Start downloading and decompressing a backup file.
 
+    Returns the running pipeline and the read end of the pipe carrying the
+    decompressed stream.
+    """
     compressor = get_compressor_by_filename(backup_path)
-    decompress_cmd = compressor.decompress_cmd if compressor else None
 
-    rclone_cmd = f'rclone --config {config.rclone_config_path} cat {remote_path}'
-    zfs_cmd = f'zfs receive -F {target_dataset}'
-    
-    if decompress_cmd:
-        full_cmd = f'set -o pipefail; {rclone_cmd} | {decompress_cmd} | {zfs_cmd}'
-    else:
+    stages = [download_stage(config, backup_path, s3_client), mbuffer_stage(config.send_buffer)]
+
+    if not compressor:
         print(f"Warning: Unknown compression for {backup_path}, attempting to restore without decompression.")
-        full_cmd = f'set -o pipefail; {rclone_cmd} | {zfs_cmd}'
+    elif decompress_stage := compressor.decompress_stage():
+        stages += [decompress_stage, mbuffer_stage(config.upload_buffer)]
+
+    read_fd, write_fd = make_pipe()
+    return Pipeline(stages, stdout=write_fd), read_fd
+
+
+def receive_backup(target_dataset: str, stream_fd: int) -> Pipeline:
+    """Start receiving the stream read from stream_fd into the target dataset."""
+    zfs_cmd = ['zfs', 'receive', '-F', target_dataset]
+    return Pipeline([zfs_cmd], stdin=stream_fd)
+
 
-    print(f"\nRunning restore for {backup_path}:")
-    print(f"  {full_cmd}")
+def restore_backups(config: BackupConfig, backups: list[BackupInfo], target_dataset: str,
+                    s3_client=None) -> BackupInfo | None:
+    """Restore backup files to the target dataset in order.
 
+    Receives run one at a time, but each backup starts downloading while the
+    previous one is being received, so the network is not idle between them.
+    Returns the backup that failed, or None if all were restored.
+    """
+    fetch, stream_fd = fetch_backup(config, backups[0].path, s3_client)
+    active = [fetch]
     try:
-        subprocess.run(full_cmd, shell=True, check=True, executable='/bin/bash')
-        print(f"Successfully restored {backup_path}")
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"Error restoring {backup_path}: {e}")
-        return False
+        for i, backup in enumerate(backups):
+            receive = receive_backup(target_dataset, stream_fd)
+            stream_fd = None
+            # Receives go first so they are terminated before the fetches feeding them,
+            # rather than being handed a truncated stream.
+            active.insert(0, receive)
+            print(f"\nRunning restore for {backup.path}:")
+            print(f"  {fetch} | {receive}")
+
+            next_fetch = None
+            if i + 1 < len(backups):
+                next_fetch, stream_fd = fetch_backup(config, backups[i + 1].path, s3_client)
+                active.append(next_fetch)
+
+            fetch_code, receive_code = fetch.wait(), receive.wait()
+            active.remove(fetch)
+            active.remove(receive)
+
+            if fetch_code != 0 or receive_code != 0:
+                print(f"Error restoring {backup.path}: download exited with code {fetch_code}, "
+                      f"receive exited with code {receive_code}")
+                return backup
+            print(f"Successfully restored {backup.path}")
+            fetch = next_fetch
+        return None
+    finally:
+        if stream_fd is not None:
+            os.close(stream_fd)
+        for pipeline in active:
+            pipeline.terminate()
 
 
 def main():
@@ -164,8 +248,14 @@ def main():
     parser = argparse.ArgumentParser(description="ZFS restore script from rclone.")
     parser.add_argument("--config", required=True, help="Path to the configuration file.")
     parser.add_argument("--target-dataset", required=True, help="The target ZFS dataset to restore to.")
+    parser.add_argument("--download-backend", choices=["rclone", "boto3"], default="rclone",
+                        help="Download with 'rclone cat' or directly from S3 with one shared boto3 client.")
     args = parser.parse_args()
 
+    if args.download_backend == "boto3" and not boto3_available():
+        print("Error: The boto3 download backend requires the 'boto3' package.")
+        sys.exit(1)
+
     config = get_config(args.config)
     print("Configuration loaded.")
     print(f"Target dataset: {args.target_dataset}")
@@ -195,17 +285,17 @@ def main():
         print("Restore cancelled.")
         sys.exit(0)
 
-    # Restore the full backup
-    if not restore_backup(config, last_full.path, args.target_dataset):
+    # One client for the whole chain, so later files reuse its connections.
+    s3_client = create_client() if args.download_backend == "boto3" else None
+
+    failed = restore_backups(config, [last_full] + incrementals, args.target_dataset, s3_client)
+    if failed is last_full:
         print("Aborting due to error in full backup restore.")
         sys.exit(1)
+    elif failed:
+        print(f"Aborting due to error in incremental backup restore: {failed.path}")
+        sys.exit(1)
 
-    # Restore incremental backups
-    for inc in incrementals:
-        if not restore_backup(config, inc.path, args.target_dataset):
-            print(f"Aborting due to error in incremental backup restore: {inc.path}")
-            sys.exit(1)
-            
     print("\nRestore completed successfully!")
 
 
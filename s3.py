@@ -0,0 +1,203 @@
+import asyncio
+import threading
+from typing import BinaryIO
+
+from pipeline import IO_CHUNK_SIZE
+
+try:
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session
+except ImportError:
+    get_session = None
+
+try:
+    import boto3
+    from botocore import exceptions as botocore_exceptions
+    from urllib3.exceptions import ProtocolError
+except ImportError:
+    boto3 = None
+    _STREAM_ERRORS = ()
+else:
+    # Errors raised when a connection drops while an object body is being read. Older
+    # botocore versions do not wrap them in ResponseStreamingError.
+    _STREAM_ERRORS = tuple(
+        getattr(botocore_exceptions, name)
+        for name in ('ResponseStreamingError', 'IncompleteReadError', 'ReadTimeoutError')
+        if hasattr(botocore_exceptions, name)
+    ) + (ProtocolError,)
+
+# Smallest part size used for multipart uploads. S3 allows at most 10000
+# parts of at most 5 GiB each.
+PART_SIZE = 64 * 1024 * 1024
+MAX_PARTS = 10000
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+
+# How often a download is resumed after an interrupted read without any progress in between.
+MAX_DOWNLOAD_RESUMES = 5
+
+
+def aioboto_available() -> bool:
+    """Return True if the aiobotocore upload backend can be used."""
+    return get_session is not None
+
+
+def boto3_available() -> bool:
+    """Return True if the boto3 download backend can be used."""
+    return boto3 is not None
+
+
+def part_size_for(estimated_size: int | None) -> int:
+    """Pick a fixed part size that fits a stream of about estimated_size bytes in MAX_PARTS parts.
+
+    Leaves 10% headroom because the estimate is taken before compression,
+    and incompressible data can grow slightly. Without an estimate, streams
+    up to MAX_PARTS * PART_SIZE (625 GiB) fit.
+    """
+    if not estimated_size:
+        return PART_SIZE
+    needed = -(-estimated_size * 11 // (10 * MAX_PARTS))
+    return min(max(PART_SIZE, needed), MAX_PART_SIZE)
+
+
+def create_client():
+    """Create a boto3 S3 client; share it between downloads to reuse its connections."""
+    return boto3.client('s3')
+
+
+class DownloadStream:
+    """Streams the body of an S3 object, resuming with a Range request if the connection drops."""
+
+    def __init__(self, client, bucket: str, key: str):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self._cancelled = threading.Event()
+
+    def run(self, dst: BinaryIO):
+        """Write the whole object to `dst`, blocking until it has been downloaded."""
+        offset = 0
+        etag = None
+        resumes = 0
+        while True:
+            self._check_cancelled()
+            kwargs = {}
+            if offset:
+                # IfMatch makes S3 refuse the resume if the object was replaced meanwhile.
+                kwargs = {'Range': f'bytes={offset}-', 'IfMatch': etag}
+            response = self.client.get_object(Bucket=self.bucket, Key=self.key, **kwargs)
+            etag = response['ETag']
+            body = response['Body']
+            start = offset
+            try:
+                for chunk in body.iter_chunks(IO_CHUNK_SIZE):
+                    self._check_cancelled()
+                    dst.write(chunk)
+                    offset += len(chunk)
+                return
+            except _STREAM_ERRORS as e:
+                resumes = 1 if offset > start else resumes + 1
+                if resumes > MAX_DOWNLOAD_RESUMES:
+                    raise
+                print(f"Download of {self.key} interrupted at byte {offset} ({e}), resuming")
+            finally:
+                body.close()
+
+    def cancel(self):
+        """Stop the download at the next chunk."""
+        self._cancelled.set()
+
+    def _check_cancelled(self):
+        if self._cancelled.is_set():
+            raise RuntimeError(f"Download of {self.key} was cancelled")
+
+
+class UploadStream:
+    """Uploads a stream of unknown length to S3 as a multipart upload with concurrent parts."""
+
+    def __init__(self, bucket: str, key: str, concurrency: int = 8, storage_class: str = 'STANDARD',
+                 part_size: int = PART_SIZE):
+        self.bucket = bucket
+        self.key = key
+        self.concurrency = concurrency
+        self.storage_class = storage_class
+        # Fixed for the whole upload, so at most concurrency * part_size bytes are held in memory.
+        self.part_size = part_size
+        self._cancelled = threading.Event()
+
+    def run(self, src: BinaryIO):
+        """Upload everything readable from `src`, blocking until the upload completes."""
+        asyncio.run(self._upload(src))
+
+    def cancel(self):
+        """Abort the upload instead of completing it, even if `src` reaches EOF."""
+        self._cancelled.set()
+
+    def _check_cancelled(self):
+        if self._cancelled.is_set():
+            raise RuntimeError(f"Upload of {self.key} was cancelled")
+
+    async def _upload(self, src: BinaryIO):
+        session = get_session()
+        client_config = AioConfig(max_pool_connections=self.concurrency)
+        async with session.create_client('s3', config=client_config) as client:
+            response = await client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, StorageClass=self.storage_class)
+            upload_id = response['UploadId']
+
+            try:
+                parts = await self._upload_parts(client, upload_id, src)
+                self._check_cancelled()
+                await client.complete_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=upload_id,
+                    MultipartUpload={'Parts': parts})
+            except BaseException:
+                await client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=upload_id)
+                raise
+
+    async def _upload_parts(self, client, upload_id: str, src: BinaryIO) -> list[dict]:
+        """Read parts from `src` and upload up to `concurrency` of them at a time."""
+        loop = asyncio.get_running_loop()
+        # Bounds both in-flight requests and the number of parts held in memory.
+        slots = asyncio.Semaphore(self.concurrency)
+        etags: dict[int, str] = {}
+        tasks: list[asyncio.Task] = []
+
+        async def upload_part(part_number: int, data: bytes):
+            try:
+                response = await client.upload_part(
+                    Bucket=self.bucket, Key=self.key, UploadId=upload_id,
+                    PartNumber=part_number, Body=data)
+                etags[part_number] = response['ETag']
+            finally:
+                slots.release()
+
+        try:
+            part_number = 1
+            while True:
+                await slots.acquire()
+                self._check_cancelled()
+                for task in tasks:
+                    if task.done() and task.exception():
+                        raise task.exception()
+
+                data = await loop.run_in_executor(None, src.read, self.part_size)
+                # An empty stream still needs one (empty) part to complete the upload.
+                if not data and part_number > 1:
+                    slots.release()
+                    break
+
+                if part_number > MAX_PARTS:
+                    raise RuntimeError(f"Stream exceeds {MAX_PARTS} parts of {self.part_size} bytes")
+
+                tasks.append(asyncio.create_task(upload_part(part_number, data)))
+                part_number += 1
+                if not data:
+                    break
+
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+        return [{'PartNumber': n, 'ETag': etags[n]} for n in sorted(etags)]